@@ -1,13 +1,25 @@
 import argparse
+import asyncio
+import bisect
 import collections
 import gzip
+import hashlib
 import json
 import os
+import threading
 from dataclasses import dataclass
+from typing import Iterator
 import datetime
-import time
 import logging
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import discord
 from discord import app_commands
 
@@ -19,6 +31,7 @@ parser.add_argument('--log_directory', type=str, default='logs', help='Directory
 parser.add_argument('--token', type=str, help='Discord token')
 parser.add_argument('--server_version', type=str, default='1.18.2', help='Server version')
 args = parser.parse_args()
+os.makedirs(args.log_directory, exist_ok=True)
 
 
 
@@ -30,10 +43,10 @@ class PricingError(ValueError):
     '''Represents an error pricing a line'''
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Repair:
     '''Represents a repair'''
-    start_time: datetime.datetime
+    start_time: datetime.time
     block_count: int
     percent_damaged: float
     materials: dict[str, int]
@@ -45,43 +58,43 @@ class Repair:
     @staticmethod
     def __split_chat_line(string: str, split: str = '[CHAT] ') -> str:
         string = string.strip()
-        strings = string.split(split)
-        if len(strings) < 2:
+        _, separator, chat = string.partition(split)
+        if not separator:
             raise SplitError(f"'{string}' cannot be split by '{split}'")
-        if len(strings) > 2:
+        if split in chat:
             raise SplitError(f"'{string}' was split by '{split}' too many times")
-        return strings[1]
+        return chat
 
     @staticmethod
-    def __split_start_line(string: str) -> time:
-        timestamp = string.split('] ')[0][1:]
-        timestamp = datetime.datetime.strptime(timestamp, '%H:%M:%S')
-        return timestamp.time()
+    def __split_start_line(string: str) -> datetime.time:
+        # Lines start with a fixed width '[HH:MM:SS] ' timestamp
+        return datetime.time(int(string[1:3]), int(string[4:6]), int(string[7:9]))
 
     @staticmethod
     def __split_material_line(string: str) -> tuple[str, int]:
-        strings = string.split(' : ')
-        if len(strings) < 2:
+        material, separator, amount = string.partition(' : ')
+        if not separator:
             raise SplitError(f"'{string}' cannot be split")
-        if len(strings) > 2:
+        if ' : ' in amount:
             raise SplitError(f"'{string}' was split too many times")
-        return strings[0], int(strings[1])
+        return material, int(amount)
 
     @staticmethod
     def __split_number_line(string: str) -> int | float:
-        strings = string.split(': ')
-        if len(strings) < 2:
+        _, separator, number = string.partition(': ')
+        if not separator:
             raise SplitError(f"'{string}' cannot be split")
-        if len(strings) > 2:
+        if ': ' in number:
             raise SplitError(f"'{string}' was split too many times")
         try:
-            return int(strings[1])
+            return int(number)
         except ValueError:
-            return float(strings[1])
+            return float(number)
 
     @staticmethod
-    def parse(lines: list[str], start_index: int, end_index: int) -> 'Repair':
-        '''Parses a repair from a list of lines'''
+    def parse(lines: dict[int, str], start_index: int, end_index: int,
+            underway_indices: list[int]) -> 'Repair':
+        '''Parses a repair from lines by index and the sorted indices of underway lines'''
         damaged_index = start_index
         percentage_index = start_index + 1
         supply_start_index = start_index + 3
@@ -117,17 +130,9 @@ class Repair:
         cost = Repair.__split_chat_line(cost)
         cost = Repair.__split_number_line(cost)
 
-        # Attempt to find starting
-        started = False
-        for index in range(cost_index + 1, min(cost_index + 100, len(lines))):
-            line = lines[index]
-            try:
-                line = Repair.__split_chat_line(line)
-            except SplitError:
-                continue
-            if line.startswith('Repairs underway: 0/'):
-                started = True
-                break
+        # Attempt to find starting within the 99 lines after the cost
+        position = bisect.bisect_right(underway_indices, cost_index)
+        started = position < len(underway_indices) and underway_indices[position] < cost_index + 100
 
         return Repair(start_time, block_count, percent_damaged, materials, time_delay, cost, started)
 
@@ -136,22 +141,27 @@ class Repair:
         '''Calculates the cost of a repair'''
         total = self.cost
         for material, amount in self.materials.items():
-            if material not in prices.keys():
+            price = prices.get(material)
+            if price is None:
                 raise PricingError(f"{material} is not in the prices dictionary")
-            total += amount * prices[material]
+            total += amount * price
         return total
 
     def json(self) -> str:
         '''Generates a json summary of this repair'''
-        return json.dumps({
-            'start_time': self.start_time.isoformat(),
+        summary = {
+            'start_time': self.start_time,
             'block_count': self.block_count,
             'percent_damaged': self.percent_damaged,
             'materials': self.materials,
             'time_delay': self.time_delay,
             'cost': self.cost,
             'started': self.started
-        })
+        }
+        if orjson is not None:
+            return orjson.dumps(summary).decode('UTF-8')
+        summary['start_time'] = self.start_time.isoformat()
+        return json.dumps(summary, ensure_ascii=False, separators=(',', ':'))
 
     def __str__(self):
         return f"{self.start_time}: {self.block_count:,} Blocks, ${self.cost:,.2f}, {self.time_delay:,.0f}s"
@@ -159,44 +169,137 @@ class Repair:
 
 
 # Utility functions
+READ_SIZE = 1024*1024
+DAMAGED_MARKER = b'Total damaged blocks: '
+COST_MARKER = b'Money to complete repair: '
+UNDERWAY_MARKER = b'[CHAT] Repairs underway: 0/'
+MARKERS = (DAMAGED_MARKER, COST_MARKER, UNDERWAY_MARKER)
+
+def find_markers(buffer: bytes, markers: tuple[bytes, ...], start: int,
+        end: int) -> Iterator[tuple[bytes, int]]:
+    '''Yields each marker found between two offsets of a buffer and its position, in order'''
+    found = [buffer.find(marker, start, end) for marker in markers]
+    while True:
+        position = min((candidate for candidate in found if candidate != -1), default=-1)
+        if position == -1:
+            return
+        marker = found.index(position)
+        yield markers[marker], position
+        # Only the first match of a marker in each line counts
+        end_of_line = buffer.find(b'\n', position, end)
+        if end_of_line == -1:
+            found[marker] = -1
+        else:
+            found[marker] = buffer.find(markers[marker], end_of_line, end)
+
 def parse_file(filename: str) -> list[Repair]:
     '''Parses a file and returns a list of repairs'''
-    if filename.endswith('.gz'):
-        with gzip.open(filename, 'rb') as file:
-            log_lines = file.read().decode('UTF-8',errors='ignore').splitlines()
-    else:
-        with open(filename, 'rb') as file:
-            log_lines = file.read().decode('UTF-8',errors='ignore').splitlines()
-
+    log_lines: dict[int, str] = {}
     repair_bounds = []
-    start = -1
-    end = -1
-    i = 0
-    for line in log_lines:
-        if 'Total damaged blocks: ' in line:
-            start = i
-        elif 'Money to complete repair: ' in line:
-            end = i
-            if start != -1:
-                repair_bounds.append((start, end))
-        i += 1
+    underway_lines = []
+
+    # Scan complete lines as they are read, only keeping bytes from an unpaired damaged line on
+    buffer = bytearray()
+    scanned = 0
+    line_index = 0
+    damaged_index = -1
+    damaged_offset = 0
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as file:
+        while True:
+            chunk = file.read(READ_SIZE)
+            buffer += chunk
+            # Only the new bytes can hold a newline past the scanned lines
+            appended = max(scanned, len(buffer) - len(chunk))
+            end = max(buffer.rfind(b'\n', appended) + 1, scanned) if chunk else len(buffer)
+            counted = scanned
+            for marker, position in find_markers(buffer, MARKERS, scanned, end):
+                line_index += buffer.count(b'\n', counted, position)
+                counted = position
+                if marker == DAMAGED_MARKER:
+                    damaged_index = line_index
+                    damaged_offset = buffer.rfind(b'\n', 0, position) + 1
+                elif marker == UNDERWAY_MARKER:
+                    # Only count lines that split by '[CHAT] ' exactly once, as in Repair.parse
+                    start_of_line = buffer.rfind(b'\n', 0, position) + 1
+                    end_of_line = buffer.find(b'\n', position, end)
+                    if end_of_line == -1:
+                        end_of_line = end
+                    line = buffer[start_of_line:end_of_line].strip()
+                    if line.count(b'[CHAT] ') == 1:
+                        underway_lines.append(line_index)
+                else:
+                    # Pair the cost line with the unpaired damaged line before it, decoding the lines between
+                    end_of_line = buffer.find(b'\n', position, end)
+                    if end_of_line == -1:
+                        end_of_line = end
+                    if damaged_index in (-1, line_index):
+                        continue
+                    if buffer.find(DAMAGED_MARKER, position, end_of_line) != -1:
+                        continue
+                    lines = buffer[damaged_offset:end_of_line]
+                    lines = lines.decode('UTF-8',errors='ignore').split('\n')
+                    log_lines.update(zip(range(damaged_index, line_index + 1), lines))
+                    repair_bounds.append((damaged_index, line_index))
+                    damaged_index = -1
+            line_index += buffer.count(b'\n', counted, end)
+
+            if not chunk:
+                break
+            # A later cost line may still need the lines from an unpaired damaged line on
+            keep = end if damaged_index == -1 else damaged_offset
+            del buffer[:keep]
+            scanned = end - keep
+            damaged_offset = 0
 
     repairs: list[Repair] = []
     for start, end in repair_bounds:
-        repair = Repair.parse(log_lines, start, end)
+        repair = Repair.parse(log_lines, start, end, underway_lines)
         repairs.append(repair)
     return repairs
 
+def hash_file(filename: str) -> str:
+    '''Hashes the contents of a file'''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        while chunk := file.read(READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Repairs parsed from recent uploads, by file contents
+PARSE_CACHE_SIZE = 64
+PARSE_CACHE_MIN_BYTES = 64*1024
+parse_cache: collections.OrderedDict[tuple[str, bool], list[Repair]] = collections.OrderedDict()
+parse_cache_lock = threading.Lock()
+
+def parse_file_cached(filename: str) -> list[Repair]:
+    '''Parses a file, reusing the repairs from an earlier upload of the same contents'''
+    # Small logs parse faster than they hash
+    if os.path.getsize(filename) < PARSE_CACHE_MIN_BYTES:
+        return parse_file(filename)
+
+    key = (hash_file(filename), filename.endswith('.gz'))
+    with parse_cache_lock:
+        if key in parse_cache:
+            parse_cache.move_to_end(key)
+            return parse_cache[key]
+    repairs = parse_file(filename)
+    with parse_cache_lock:
+        parse_cache[key] = repairs
+        if len(parse_cache) > PARSE_CACHE_SIZE:
+            parse_cache.popitem(last=False)
+    return repairs
+
 def load_materials() -> dict[str, int]:
     '''Loads the materials from the materials yaml file'''
     with open(f"material_costs_{args.server_version}.yml", 'r', encoding='UTF-8') as file:
-        costs = yaml.safe_load(file)
+        costs = yaml.load(file, Loader=SafeLoader)
     return costs
 
 def load_guilds() -> list[int]:
     '''Loads the guilds from the guilds yaml file'''
     with open('guilds.yml', 'r', encoding='UTF-8') as file:
-        guilds = yaml.safe_load(file)
+        guilds = yaml.load(file, Loader=SafeLoader)
     return guilds['guilds']
 
 # Discord.py stuff
@@ -241,36 +344,34 @@ def __format_delay(delay: int) -> str:
     days = hours // 24
     hours %= 24
 
-    result = ''
+    parts = []
     if days > 0:
-        result += f"{days:,.0f}d "
+        parts.append(f"{days:,.0f}d")
     if hours > 0:
-        result += f"{hours:,.0f}h "
+        parts.append(f"{hours:,.0f}h")
     if minutes > 0:
-        result += f"{minutes:,.0f}m "
+        parts.append(f"{minutes:,.0f}m")
     if seconds > 0:
-        result += f"{seconds:,.0f}s "
-    result += f"({delay:,.0f}s)"
-    return result
+        parts.append(f"{seconds:,.0f}s")
+    parts.append(f"({delay:,.0f}s)")
+    return ' '.join(parts)
 
-@tree.command(name='parse')
-@app_commands.describe(attachment='The log file to upload')
-async def parse_summary(interaction: discord.Interaction, attachment: discord.Attachment):
-    '''Respond to an uploaded logfile with a summary'''
+async def __receive(interaction: discord.Interaction, attachment: discord.Attachment):
+    '''Checks, downloads and parses an uploaded logfile, responding on failure'''
     # Check allowed guilds
     if interaction.guild_id not in allowed_guilds:
         await interaction.response.send_message("This server is not allowed to use this bot")
-        return
+        return None
     # Check file name and size
     if not attachment.filename.endswith('.log.gz') and not attachment.filename.endswith('.log'):
         await interaction.response.send_message('File must be a .log.gz or .log file',
             ephemeral=True)
         log(interaction, attachment.filename, '', 'Wrong type')
-        return
+        return None
     if attachment.size > 32*1024*1024:
         await interaction.response.send_message('File must be less than 32MiB', ephemeral=True)
         log(interaction, attachment.filename, '', f"Too large ({attachment.size:,} bytes)")
-        return
+        return None
 
     # Defer response
     await interaction.response.defer(ephemeral=True, thinking=True)
@@ -279,57 +380,75 @@ async def parse_summary(interaction: discord.Interaction, attachment: discord.At
     try:
         filename = f"{datetime.datetime.now().isoformat()}_{interaction.user.id}_{attachment.filename}"
         filename = os.path.join(args.log_directory, filename)
-        if not os.path.exists(args.log_directory):
-            os.mkdir(args.log_directory)
         await attachment.save(filename)
     except (discord.HTTPException, discord.NotFound) as exception:
         await interaction.followup.send(f"Error downloading attachment: {exception}",
             ephemeral=True)
         log(interaction, attachment.filename, filename, f"{exception}")
-        return
+        return None
     except BaseException as exception:
         await interaction.followup.send(f"Unknown error downloading: {exception}", ephemeral=True)
         log(interaction, attachment.filename, filename, f"{exception}")
-        return
+        return None
 
     # Attempt parsing
     try:
-        repairs = parse_file(filename)
+        repairs = await asyncio.to_thread(parse_file_cached, filename)
     except SplitError as exception:
         await interaction.followup.send(f"Error pricing - {exception}", ephemeral=True)
         log(interaction, attachment.filename, filename, f"{exception}")
-        return
+        return None
     except BaseException as exception:
         await interaction.followup.send(f"Unknown error parsing: {exception}", ephemeral=True)
         log(interaction, attachment.filename, filename, f"{exception}")
+        return None
+
+    return filename, repairs
+
+async def __send(interaction: discord.Interaction, results: collections.deque):
+    '''Sends results in as few messages as fit under the length limit'''
+    chunks = []
+    while len(results) > 0:
+        chunks.clear()
+        length = 0
+        while len(results) > 0 and length + len(results[0]) < 2000:
+            chunk = results.popleft()
+            chunks.append(chunk)
+            length += len(chunk) + 1
+        message = '\n'.join(chunks) + '\n'
+        await interaction.followup.send(message, ephemeral=True)
+
+@tree.command(name='parse')
+@app_commands.describe(attachment='The log file to upload')
+async def parse_summary(interaction: discord.Interaction, attachment: discord.Attachment):
+    '''Respond to an uploaded logfile with a summary'''
+    received = await __receive(interaction, attachment)
+    if received is None:
         return
+    filename, repairs = received
 
     # Attempt summarizing
     try:
         results = collections.deque()
         results.append(f"{len(repairs)} repair{'' if len(repairs) == 1 else 's'} found")
         for repair in repairs:
-            result = f"> {repair.start_time}: {repair.block_count:,} Blocks"
+            parts = [f"> {repair.start_time}: {repair.block_count:,} Blocks"]
             try:
-                result += f", ${repair.total_cost(material_costs):,.2f} & "
-                result += __format_delay(repair.time_delay)
+                parts.append(f", ${repair.total_cost(material_costs):,.2f} & ")
+                parts.append(__format_delay(repair.time_delay))
                 if repair.started:
-                    result += f" - Started for ${repair.cost:,.2f}"
+                    parts.append(f" - Started for ${repair.cost:,.2f}")
             except PricingError as exception:
-                result += f" & Error pricing: {exception}"
+                parts.append(f" & Error pricing: {exception}")
                 logger.info('Error pricing: %s', exception)
-            results.append(result)
+            results.append(''.join(parts))
     except BaseException as exception:
         await interaction.followup.send(f"Unknown error summarizing: {exception}", ephemeral=True)
         log(interaction, attachment.filename, filename, f"{exception}")
         return
 
     # Send results
-    while len(results) > 0:
-        message = ''
-        while len(message) < 2000 and len(results) > 0 and len(message) + len(results[0]) < 2000:
-            message += f"{results.popleft()}\n"
-        await interaction.followup.send(message, ephemeral=True)
+    await __send(interaction, results)
     log(interaction, attachment.filename, filename)
 
 
@@ -337,52 +456,10 @@ async def parse_summary(interaction: discord.Interaction, attachment: discord.At
 @app_commands.describe(attachment='The log file to upload')
 async def parse_json(interaction: discord.Interaction, attachment: discord.Attachment):
     '''Respond to an uploaded logfile with JSON'''
-    # Check allowed guilds
-    if interaction.guild_id not in allowed_guilds:
-        await interaction.response.send_message("This server is not allowed to use this bot")
-        return
-    # Check file name and size
-    if not attachment.filename.endswith('.log.gz') and not attachment.filename.endswith('.log'):
-        await interaction.response.send_message('File must be a .log.gz or .log file',
-            ephemeral=True)
-        log(interaction, attachment.filename, '', 'Wrong type')
-        return
-    if attachment.size > 32*1024*1024:
-        await interaction.response.send_message('File must be less than 32MiB', ephemeral=True)
-        log(interaction, attachment.filename, '', f"Too large ({attachment.size:,} bytes)")
-        return
-
-    # Defer response
-    await interaction.response.defer(ephemeral=True, thinking=True)
-
-    # Attempt to download
-    try:
-        filename = f"{datetime.datetime.now().isoformat()}_{interaction.user.id}_{attachment.filename}"
-        filename = os.path.join(args.log_directory, filename)
-        if not os.path.exists(args.log_directory):
-            os.mkdir(args.log_directory)
-        await attachment.save(filename)
-    except (discord.HTTPException, discord.NotFound) as exception:
-        await interaction.followup.send(f"Error downloading attachment: {exception}",
-            ephemeral=True)
-        log(interaction, attachment.filename, filename, f"{exception}")
-        return
-    except BaseException as exception:
-        await interaction.followup.send(f"Unknown error downloading: {exception}", ephemeral=True)
-        log(interaction, attachment.filename, filename, f"{exception}")
-        return
-
-    # Attempt parsing
-    try:
-        repairs = parse_file(filename)
-    except SplitError as exception:
-        await interaction.followup.send(f"Error pricing - {exception}", ephemeral=True)
-        log(interaction, attachment.filename, filename, f"{exception}")
-        return
-    except BaseException as exception:
-        await interaction.followup.send(f"Unknown error parsing: {exception}", ephemeral=True)
-        log(interaction, attachment.filename, filename, f"{exception}")
+    received = await __receive(interaction, attachment)
+    if received is None:
         return
+    filename, repairs = received
 
     # Attempt detailing
     results = collections.deque()
@@ -391,11 +468,7 @@ async def parse_json(interaction: discord.Interaction, attachment: discord.Attac
         results.append(f"```json\n{repair.json()}\n```\n")
 
     # Send results
-    while len(results) > 0:
-        message = ''
-        while len(message) < 2000 and len(results) > 0 and len(message) + len(results[0]) < 2000:
-            message += f"{results.popleft()}\n"
-        await interaction.followup.send(message, ephemeral=True)
+    await __send(interaction, results)
     log(interaction, attachment.filename, filename)
 
 client.run(args.token)